@@ -1,22 +1,668 @@
+import asyncio
+import copy
+import functools
+import json
 import os
 import logging
-from flask import Flask, render_template, request, jsonify, send_file, flash, redirect, url_for
+import queue
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from flask import (Flask, Response, render_template, request, jsonify, send_file,
+                   flash, redirect, url_for, stream_with_context)
 import yt_dlp
-from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "local_dev_secret_key")
+# Behind Apache with mod_xsendfile, let the server move the file bytes
+# itself (sendfile(2)) instead of pumping them through the Python worker.
+# Off by default so plain `python app.py` keeps serving real bodies.
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
-# Local downloads directory
-DOWNLOADS_DIR = Path("downloads")
-DOWNLOADS_DIR.mkdir(exist_ok=True)
+# Extraction dominates request latency, so cache the parsed info dict per
+# video for a few minutes. An /analyze followed by /download or /preview of
+# the same video then skips the watch-page + player-JS round trip entirely.
+INFO_CACHE_TTL = 300  # seconds
+_info_cache = {}  # video_id -> (timestamp, info)
+_info_cache_lock = threading.Lock()
+
+# Building a YoutubeDL instance re-reads config and rebuilds the extractor
+# list on every call, and tearing it down throws away its HTTP connection
+# pool and cached player JS. Keep one live instance per (thread, option
+# signature) and reuse it so repeat calls skip the TCP/TLS handshake too.
+_ydl_pool = {}
+_ydl_pool_lock = threading.Lock()
 
 # Global progress tracker
 download_progress = {}
 
+def get_ydl(ydl_opts):
+    """Return a reusable YoutubeDL instance for this exact set of options.
+
+    YoutubeDL itself is not thread-safe (cookiejar, cache and extractor
+    state are per-instance), so the pool is also keyed by calling thread:
+    each worker owns its instances outright and concurrent extractions
+    never contend, while repeat calls on the same thread still reuse the
+    warm connection pool. The thread population is small and fixed (the
+    analyze executor plus the WSGI workers), so the pool stays bounded.
+    """
+    key = (threading.get_ident(),
+           tuple(sorted((k, repr(v)) for k, v in ydl_opts.items())))
+    with _ydl_pool_lock:
+        ydl = _ydl_pool.get(key)
+        if ydl is None:
+            ydl = _ydl_pool[key] = yt_dlp.YoutubeDL(ydl_opts)
+    return ydl
+
+# Completed/failed jobs older than this are purged along with their temp dirs
+JOB_TTL = 30 * 60  # seconds
+
+# All periodic housekeeping runs cooperatively on one shared event loop
+# instead of burning an OS thread per sleep-and-sweep loop.
+_maintenance_loop = asyncio.new_event_loop()
+threading.Thread(target=_maintenance_loop.run_forever, daemon=True).start()
+
+# Temp dirs are unlinked off the serving path: deleting hundreds of MB is
+# disk I/O a finished response should never wait on. Enqueueing is
+# microseconds; the daemon batches whatever has piled up.
+_cleanup_queue = queue.SimpleQueue()
+
+def _cleanup_worker():
+    while True:
+        shutil.rmtree(_cleanup_queue.get(), ignore_errors=True)
+
+threading.Thread(target=_cleanup_worker, daemon=True).start()
+
+def discard_dir(path):
+    """Queue a directory for deletion on the cleanup worker."""
+    if path:
+        _cleanup_queue.put(path)
+
+# Downloads are I/O-bound, so a few can run in parallel and saturate the
+# link; the semaphore keeps disk and bandwidth use bounded.
+MAX_CONCURRENT_DOWNLOADS = 3
+
+# Individual YouTube streams are throttled per connection; fetching
+# fragments and 10MB chunks in parallel regularly multiplies throughput.
+# Shared by every download code path.
+DOWNLOAD_TUNING = {
+    'concurrent_fragment_downloads': 4,
+    'http_chunk_size': 10 * 1024 * 1024,
+    'retries': 3,
+    'fragment_retries': 5,
+}
+
+@dataclass(slots=True)
+class Job:
+    """State of one download job.
+
+    Slotted so each job is a fixed struct with direct attribute access
+    instead of a dict-of-dicts entry that re-hashes keys on every touch.
+    """
+    status: str = 'queued'
+    progress: float = 0.0
+    status_text: str = 'Queued'
+    error: str = None
+    file_path: str = None
+    temp_dir: str = None
+    created_at: float = field(default_factory=time.time)
+    dedup_key: tuple = None  # (video_id, format_spec), see create_job
+
+@dataclass(slots=True)
+class Progress:
+    """Progress of a legacy direct download, keyed by video id."""
+    percentage: float = 0.0
+    status: str = 'waiting'
+
+class DownloadManager:
+    """Runs downloads on worker threads and tracks their state by job id."""
+
+    # Minimum seconds between progress updates; yt-dlp fires its hook per
+    # chunk, and relaying every one would hammer the lock and the SSE
+    # subscribers hundreds of times a second for no visible gain.
+    PROGRESS_INTERVAL = 0.25
+
+    def __init__(self, max_workers=8):
+        self.jobs = {}
+        self.key_to_job = {}  # (video_id, format_spec) -> job_id
+        self.listeners = {}  # job_id -> [queue.Queue] of SSE subscribers
+        self._progress_ts = {}  # job_id -> monotonic time of last update
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(MAX_CONCURRENT_DOWNLOADS)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        asyncio.run_coroutine_threadsafe(self._cleanup_loop(), _maintenance_loop)
+
+    @staticmethod
+    def _public(job):
+        """Job state with server-side paths stripped, safe for clients."""
+        return {k: v for k, v in asdict(job).items()
+                if k not in ('temp_dir', 'file_path')}
+
+    def get_status(self, job_id):
+        """Return the client-facing state of a job, or None."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return self._public(job) if job else None
+
+    def subscribe(self, job_id):
+        """Register an SSE listener; every job update is pushed onto it."""
+        listener = queue.Queue()
+        with self.lock:
+            self.listeners.setdefault(job_id, []).append(listener)
+        return listener
+
+    def unsubscribe(self, job_id, listener):
+        with self.lock:
+            listeners = self.listeners.get(job_id, [])
+            if listener in listeners:
+                listeners.remove(listener)
+            if not listeners:
+                self.listeners.pop(job_id, None)
+
+    def create_job(self, url, format_spec):
+        """Queue a download; returns (job_id, queue_position).
+
+        Requests for the same (video, format) pair are deduplicated: a
+        retry or a second user gets the id of the job that is already
+        running, or of a completed one whose file is still on disk, so
+        duplicates cost zero yt-dlp round trips.
+        """
+        video_id = extract_video_id(url)
+        key = (video_id, format_spec) if video_id else None
+        with self.lock:
+            if key:
+                existing_id = self.key_to_job.get(key)
+                existing = self.jobs.get(existing_id)
+                if existing and (
+                        existing.status in ('queued', 'downloading', 'processing')
+                        or (existing.status == 'completed' and existing.file_path
+                            and os.path.exists(existing.file_path))):
+                    return existing_id, 0
+            in_flight = sum(1 for job in self.jobs.values()
+                            if job.status in ('queued', 'downloading', 'processing'))
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = Job(dedup_key=key)
+            if key:
+                self.key_to_job[key] = job_id
+        queue_position = max(0, in_flight + 1 - MAX_CONCURRENT_DOWNLOADS)
+        self.executor.submit(self._process_download, job_id, url, format_spec)
+        return job_id, queue_position
+
+    def _forget_key(self, job_id):
+        """Stop routing duplicate requests to a job that can't serve them."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job and job.dedup_key and self.key_to_job.get(job.dedup_key) == job_id:
+                del self.key_to_job[job.dedup_key]
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def update_job(self, job_id, **fields):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return
+            for name, value in fields.items():
+                setattr(job, name, value)
+            snapshot = self._public(job)
+            listeners = list(self.listeners.get(job_id, ()))
+        for listener in listeners:
+            listener.put(snapshot)
+
+    def _progress_hook(self, job_id, d):
+        if d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+            downloaded = d.get('downloaded_bytes', 0)
+            if total > 0:
+                percent = (downloaded / total) * 100
+                now = time.monotonic()
+                # Cheap timestamp check before any locking; the final 100%
+                # always goes through
+                if (percent < 100
+                        and now - self._progress_ts.get(job_id, 0.0) < self.PROGRESS_INTERVAL):
+                    return
+                self._progress_ts[job_id] = now
+                self.update_job(job_id, status='downloading', progress=round(percent, 1),
+                                status_text=f'Downloading... {percent:.0f}%')
+        elif d['status'] == 'finished':
+            self._progress_ts.pop(job_id, None)
+            self.update_job(job_id, status='processing', progress=100.0,
+                            status_text='Processing / merging...')
+
+    def _process_download(self, job_id, url, format_spec):
+        if not self.slots.acquire(blocking=False):
+            # All slots busy - stay 'queued' until one frees up
+            self.update_job(job_id, status_text='Waiting for a download slot...')
+            self.slots.acquire()
+        try:
+            self._run_download(job_id, url, format_spec)
+        finally:
+            self.slots.release()
+
+    def _run_download(self, job_id, url, format_spec):
+        temp_dir = tempfile.mkdtemp(prefix='tubefetch_')
+        self.update_job(job_id, temp_dir=temp_dir, status='downloading',
+                        status_text='Starting download...')
+        try:
+            ydl_opts = {
+                'format': format_spec,
+                'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
+                'progress_hooks': [functools.partial(self._progress_hook, job_id)],
+                'noplaylist': True,
+                'quiet': True,
+                'no_warnings': True,
+                **DOWNLOAD_TUNING,
+            }
+            if '+' in format_spec:
+                apply_merge_opts(ydl_opts, url, format_spec)
+            # The per-job progress hook makes these options unique, so a
+            # pooled instance would never be reused - build one directly.
+            ydl = yt_dlp.YoutubeDL(ydl_opts)
+            info = download_with_cached_info(ydl, url)
+            filename = ydl.prepare_filename(info)
+
+            # yt-dlp may change the extension after a merge. scandir carries
+            # the file type with each entry, so recovery is one pass without
+            # a stat call per name; the largest file wins, since a leftover
+            # .part fragment can never outweigh the merged output.
+            if not os.path.exists(filename):
+                with os.scandir(temp_dir) as entries:
+                    files = [e for e in entries if e.is_file()]
+                filename = max(files, key=lambda e: e.stat().st_size).path if files else None
+
+            if not filename or not os.path.exists(filename):
+                raise FileNotFoundError('Downloaded file not found')
+            self.update_job(job_id, status='completed', progress=100.0,
+                            status_text='Completed', file_path=filename)
+        except Exception as e:
+            logging.error(f"Download job {job_id} failed: {e}")
+            self.update_job(job_id, status='error', error=str(e),
+                            status_text='Download failed')
+            self._forget_key(job_id)
+            discard_dir(temp_dir)
+        finally:
+            # The hook only pops this on a clean 'finished'; a job that
+            # errors mid-download would otherwise leak its entry for the
+            # life of the process
+            self._progress_ts.pop(job_id, None)
+
+    async def _cleanup_loop(self):
+        """Periodically drop finished jobs and their leftover temp dirs.
+
+        Runs on the shared maintenance loop; job state itself stays behind
+        the threading.Lock because the download workers are real threads.
+        """
+        while True:
+            await asyncio.sleep(60)
+            cutoff = time.time() - JOB_TTL
+            with self.lock:
+                stale = [job_id for job_id, job in self.jobs.items()
+                         if job.created_at < cutoff
+                         and job.status in ('completed', 'error')]
+                removed = []
+                for job_id in stale:
+                    job = self.jobs.pop(job_id)
+                    if job.dedup_key and self.key_to_job.get(job.dedup_key) == job_id:
+                        del self.key_to_job[job.dedup_key]
+                    removed.append(job)
+            for job in removed:
+                discard_dir(job.temp_dir)
+
+download_manager = DownloadManager()
+
+# Analysis is pure I/O, so it parallelizes well on threads; running it off
+# the request thread keeps WSGI workers free to accept new users.
+ANALYZE_EXECUTOR = ThreadPoolExecutor(max_workers=8)
+analyze_jobs = {}  # job_id -> {'future': Future, 'created_at': timestamp}
+_analyze_jobs_lock = threading.Lock()
+
+async def _state_cleanup_loop():
+    """Expire finished analyze jobs and stale info-cache entries."""
+    while True:
+        await asyncio.sleep(60)
+        cutoff = time.time() - JOB_TTL
+        with _analyze_jobs_lock:
+            stale = [job_id for job_id, job in analyze_jobs.items()
+                     if job['created_at'] < cutoff and job['future'].done()]
+            for job_id in stale:
+                del analyze_jobs[job_id]
+        expiry = time.time() - INFO_CACHE_TTL
+        with _info_cache_lock:
+            expired = [video_id for video_id, (ts, _) in _info_cache.items()
+                       if ts < expiry]
+            for video_id in expired:
+                del _info_cache[video_id]
+
+asyncio.run_coroutine_threadsafe(_state_cleanup_loop(), _maintenance_loop)
+
+# Validation is hostname-first: an O(1) membership test rejects non-YouTube
+# input before any pattern matching runs. The id pattern is compiled once at
+# import and is fully bounded, so adversarial input can't cause backtracking.
+_YT_HOSTS = ('youtube.com', 'www.youtube.com', 'm.youtube.com',
+             'music.youtube.com', 'youtube-nocookie.com',
+             'www.youtube-nocookie.com', 'youtu.be')
+_YT_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def is_valid_youtube_url(url):
+    """Check that url points at a known YouTube host and names a video."""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    if parsed.scheme not in ('http', 'https'):
+        return False
+    if (parsed.hostname or '').lower() not in _YT_HOSTS:
+        return False
+    video_id = extract_video_id(url)
+    return bool(video_id and _YT_ID_RE.match(video_id))
+
+def extract_video_id(url):
+    """Pull the video id out of a YouTube URL, or None if it has none."""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return None
+    host = (parsed.hostname or '').lower()
+    if host == 'youtu.be':
+        return parsed.path.lstrip('/').split('/')[0] or None
+    if 'youtube' in host:
+        if parsed.path == '/watch':
+            return parse_qs(parsed.query).get('v', [None])[0]
+        for prefix in ('/shorts/', '/embed/', '/live/'):
+            if parsed.path.startswith(prefix):
+                return parsed.path[len(prefix):].split('/')[0] or None
+    return None
+
+def get_video_info(url):
+    """Extract video info, reusing a recent cached result for the same video."""
+    video_id = extract_video_id(url)
+    if video_id:
+        with _info_cache_lock:
+            cached = _info_cache.get(video_id)
+        if cached and time.time() - cached[0] < INFO_CACHE_TTL:
+            return cached[1]
+
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        # Every player client yt-dlp queries costs its own network round
+        # trip; the web client alone returns the full format list the UI
+        # shows, so skip the extra embedded/TV client requests.
+        'extractor_args': {'youtube': {'player_client': ['web']}},
+    }
+    try:
+        ydl = get_ydl(ydl_opts)
+        info = ydl.extract_info(url, download=False)
+    except Exception:
+        # Don't keep serving a stale entry for a video that now fails
+        if video_id:
+            with _info_cache_lock:
+                _info_cache.pop(video_id, None)
+        raise
+    with _info_cache_lock:
+        _info_cache[info['id']] = (time.time(), info)
+    return info
+
+def download_with_cached_info(ydl, url):
+    """Run a download, skipping re-extraction when the info dict is cached."""
+    video_id = extract_video_id(url)
+    cached = None
+    if video_id:
+        with _info_cache_lock:
+            cached = _info_cache.get(video_id)
+    if cached and time.time() - cached[0] < INFO_CACHE_TTL:
+        # process_ie_result mutates the info dict, so hand it a copy
+        return ydl.process_ie_result(copy.deepcopy(cached[1]), download=True)
+    return ydl.extract_info(url, download=True)
+
+# Probed once at startup; spawning 'ffmpeg -version' per job just to
+# re-discover this was a fork+exec in every download's hot path.
+HAS_FFMPEG = bool(shutil.which('ffmpeg'))
+
+# Codecs that stream-copy cleanly into an mp4 container. vp9 and av01
+# matter here: YouTube serves most 1080p and everything above it only in
+# those, and both remux into mp4 fine - re-encoding them would turn the
+# common high-res merge into a full transcode.
+_MP4_VIDEO_CODECS = ('avc1', 'h264', 'av01', 'vp9', 'vp09')
+_MP4_AUDIO_CODECS = ('mp4a', 'aac')
+
+# When a stream has to be re-encoded this is not a quality-critical pass,
+# so trade compression for wall time and use every core.
+_TRANSCODE_TUNING = ['-preset', 'ultrafast', '-crf', '23',
+                     '-threads', str(os.cpu_count() or 1)]
+
+# Hardware H.264 encoders in preference order, each with its own
+# fastest-preset arguments (nvenc's p1 is the ultrafast equivalent).
+_HW_ENCODERS = (
+    ('h264_nvenc', ['-preset', 'p1']),
+    ('h264_videotoolbox', []),
+    ('h264_qsv', ['-preset', 'veryfast']),
+)
+
+def _encoder_works(name):
+    """Test-encode one black frame to prove the encoder actually runs.
+
+    ffmpeg lists every encoder it was built with, so e.g. h264_nvenc
+    shows up on machines with no NVIDIA runtime and only fails once a
+    real merge tries to use it.
+    """
+    try:
+        test = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-v', 'error',
+             '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+             '-frames:v', '1', '-pix_fmt', 'yuv420p',
+             '-c:v', name, '-f', 'null', '-'],
+            capture_output=True, timeout=15)
+        return test.returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+def _detect_video_encoder():
+    """Pick the fastest available H.264 encoder, probed once at startup."""
+    try:
+        probe = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                               capture_output=True, text=True, timeout=10)
+        encoders = probe.stdout
+    except (OSError, subprocess.SubprocessError):
+        encoders = ''
+    for name, preset_args in _HW_ENCODERS:
+        if name in encoders and _encoder_works(name):
+            logging.info(f"Using hardware video encoder: {name}")
+            return ['-c:v', name] + preset_args
+    return ['-c:v', 'libx264'] + _TRANSCODE_TUNING
+
+VIDEO_ENCODER_ARGS = _detect_video_encoder()
+
+def _merge_codecs(url, video_format_id, audio_format_id):
+    """Look up the codec pair for a merge from the info cache, if present."""
+    video_id = extract_video_id(url)
+    cached = None
+    if video_id:
+        with _info_cache_lock:
+            cached = _info_cache.get(video_id)
+    if not cached:
+        return None, None
+    formats = {f.get('format_id'): f for f in cached[1].get('formats', [])}
+    return ((formats.get(video_format_id) or {}).get('vcodec'),
+            (formats.get(audio_format_id) or {}).get('acodec'))
+
+def apply_merge_opts(ydl_opts, url, format_spec):
+    """Configure a video+audio merge into the mp4 the UI advertises.
+
+    Streams whose codecs fit mp4 are copied, which is an order of
+    magnitude faster than encoding; only a stream that genuinely can't be
+    copied (e.g. opus audio) gets re-encoded, and then with the ultrafast
+    tuning above. With a cold cache the codecs are unknown, so the merge
+    stays a pure copy into mkv, which accepts any codec pair - forcing
+    mp4 blind would make ffmpeg fail on e.g. opus audio. Callers read
+    merge_output_format back for the advertised filename, so it is
+    always a single concrete container.
+    """
+    video_format_id, audio_format_id = format_spec.split('+', 1)
+    vcodec, acodec = _merge_codecs(url, video_format_id, audio_format_id)
+    ydl_opts['prefer_ffmpeg'] = True
+    if vcodec is None and acodec is None:
+        ydl_opts['merge_output_format'] = 'mkv'
+        ydl_opts['postprocessor_args'] = {
+            'ffmpeg_i': ['-probesize', '10M', '-analyzeduration', '10M'],
+        }
+        return
+    args = []
+    if vcodec and not vcodec.startswith(_MP4_VIDEO_CODECS):
+        args += VIDEO_ENCODER_ARGS
+    else:
+        args += ['-c:v', 'copy']
+    if acodec and not acodec.startswith(_MP4_AUDIO_CODECS):
+        args += ['-c:a', 'aac']
+    else:
+        args += ['-c:a', 'copy']
+    args += ['-movflags', '+faststart']
+    ydl_opts['merge_output_format'] = 'mp4'
+    ydl_opts['postprocessor_args'] = {
+        'ffmpeg': args,
+        # Bound the demuxer's startup probing of the (local, known-container)
+        # inputs so ffmpeg starts muxing without long analysis passes
+        'ffmpeg_i': ['-probesize', '10M', '-analyzeduration', '10M'],
+    }
+
+# Extensions whose mimetype doesn't follow the plain video/<ext> or
+# audio/<ext> pattern
+_EXT_MIME = {'m4a': 'audio/mp4', 'mkv': 'video/x-matroska'}
+
+def _cached_format(url, format_id):
+    """Look up (title, format dict) for a stream from the info cache."""
+    video_id = extract_video_id(url)
+    cached = None
+    if video_id:
+        with _info_cache_lock:
+            cached = _info_cache.get(video_id)
+    if not cached:
+        return None, None
+    info = cached[1]
+    fmt = next((f for f in info.get('formats', [])
+                if f.get('format_id') == format_id), None)
+    return info.get('title'), fmt
+
+STREAM_CHUNK_SIZE = 256 * 1024
+
+def _newest_file(directory):
+    """Return the most recently modified file in directory, or None."""
+    with os.scandir(directory) as entries:
+        files = [e for e in entries if e.is_file()]
+    return max(files, key=lambda e: e.stat().st_mtime).path if files else None
+
+# Artifacts of a fragmented (m3u8/DASH) download: per-fragment pieces and
+# yt-dlp's control file
+_FRAGMENT_MARKERS = ('.part-Frag', '.ytdl')
+
+def _pick_tail_target(temp_dir, video_id):
+    """Choose the single-file download output to tail, or flag fragments.
+
+    Returns (path, fragmented). Fragmented downloads fill the dir with
+    .part-FragN pieces and a .ytdl control file; tailing across those
+    would interleave bytes from different files into the response, so any
+    sign of them disables tailing. The output itself must match the
+    '%(id)s.%(ext)s' outtmpl (with or without the .part suffix), and only
+    an unambiguous single match is accepted.
+    """
+    prefix = f"{video_id}."
+    candidates = []
+    with os.scandir(temp_dir) as entries:
+        for entry in entries:
+            if any(marker in entry.name for marker in _FRAGMENT_MARKERS):
+                return None, True
+            if entry.is_file() and entry.name.startswith(prefix):
+                candidates.append(entry.path)
+    if len(candidates) == 1:
+        return candidates[0], False
+    # Nothing yet, or more than one match - don't guess
+    return None, False
+
+def stream_download(ydl_opts, url, download_name, progressive, mimetype='video/mp4'):
+    """Download into a temp dir and stream the result straight to the client.
+
+    With progressive=True the response tails the file while yt-dlp is still
+    writing it, so bytes reach the browser as they arrive instead of after
+    the whole file lands on disk. Merged downloads pass progressive=False
+    because ffmpeg has to finish muxing before the output is readable.
+    """
+    temp_dir = tempfile.mkdtemp(prefix='tubefetch_')
+    ydl_opts = dict(ydl_opts, outtmpl=os.path.join(temp_dir, '%(id)s.%(ext)s'))
+    result = {}
+
+    def worker():
+        try:
+            ydl = yt_dlp.YoutubeDL(ydl_opts)
+            result['info'] = download_with_cached_info(ydl, url)
+        except Exception as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+
+    video_id = extract_video_id(url)
+
+    def generate():
+        try:
+            target = None
+            offset = 0
+            tail = progressive and video_id is not None
+            while True:
+                finished = not thread.is_alive()
+                if tail and target is None:
+                    target, fragmented = _pick_tail_target(temp_dir, video_id)
+                    if fragmented:
+                        tail = False
+                if target:
+                    if not os.path.exists(target) and target.endswith('.part'):
+                        # Renamed on completion; the content is identical,
+                        # so the offset carries over
+                        target = target[:-len('.part')]
+                    if os.path.exists(target):
+                        with open(target, 'rb') as fh:
+                            fh.seek(offset)
+                            while True:
+                                chunk = fh.read(STREAM_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                offset += len(chunk)
+                                yield chunk
+                if finished:
+                    break
+                time.sleep(0.2)
+            if 'error' in result:
+                raise result['error']
+            if target is None:
+                # Buffered mode (merge, or fragmented download): stream the
+                # finished output in one pass
+                final = _newest_file(temp_dir)
+                if final:
+                    with open(final, 'rb') as fh:
+                        while True:
+                            chunk = fh.read(STREAM_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            yield chunk
+        finally:
+            discard_dir(temp_dir)
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    # headers.set quotes/escapes the filename; titles can contain quotes
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    return response
+
 def progress_hook(d):
     """Track download progress"""
     if d['status'] == 'downloading':
@@ -25,21 +671,101 @@ def progress_hook(d):
         downloaded = d.get('downloaded_bytes', 0)
         if total > 0:
             percentage = (downloaded / total) * 100
-            download_progress[video_id] = {
-                'percentage': round(percentage, 1),
-                'status': 'downloading'
-            }
+            download_progress[video_id] = Progress(round(percentage, 1), 'downloading')
     elif d['status'] == 'finished':
         video_id = d.get('info_dict', {}).get('id', 'unknown')
-        download_progress[video_id] = {
-            'percentage': 100.0,
-            'status': 'complete'
-        }
+        download_progress[video_id] = Progress(100.0, 'complete')
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def _build_merge_option(video, audio):
+    """Pair a video-only stream with the best audio for auto-merging."""
+    return {
+        'resolution': video['resolution'],
+        'fps': video['fps'],
+        'video_format_id': video['format_id'],
+        'audio_format_id': audio['format_id'],
+        'vcodec': video['vcodec'],
+        'acodec': audio['acodec'],
+    }
+
+def _do_analyze(url):
+    """Analyze a YouTube video and return the template context dict"""
+    # Simple analysis - no restrictions
+    info = get_video_info(url)
+
+    duration = info.get('duration', 0)
+    video_info = {
+        'title': info.get('title', 'Unknown'),
+        'author': info.get('uploader', 'Unknown'),
+        'length': f"{duration // 60}:{duration % 60:02d}",
+        'thumbnail': info.get('thumbnail', ''),
+        'video_id': info.get('id'),
+        'url': url,
+    }
+
+    # Get all formats without filtering
+    formats = info.get('formats', [])
+    video_audio_streams = []
+    video_only_streams = []
+    audio_only_streams = []
+
+    for fmt in formats:
+        height = fmt.get('height')
+        ext = fmt.get('ext', 'unknown')
+        vcodec = fmt.get('vcodec', 'none')
+        acodec = fmt.get('acodec', 'none')
+        filesize = fmt.get('filesize') or fmt.get('filesize_approx', 0)
+
+        if ext == 'mhtml':
+            continue
+
+        stream = {
+            'format_id': fmt['format_id'],
+            'resolution': f"{height}p" if height else "Audio",
+            '_height': height or 0,
+            'filesize': format_bytes(filesize),
+            'ext': ext,
+            'vcodec': vcodec,
+            'acodec': acodec,
+            'fps': fmt.get('fps'),
+        }
+
+        if vcodec != 'none' and acodec != 'none':
+            video_audio_streams.append(stream)
+        elif vcodec != 'none':
+            video_only_streams.append(stream)
+        elif acodec != 'none':
+            audio_only_streams.append(stream)
+
+    # Sort by quality - the numeric height was stored at build time, so the
+    # comparator does no string parsing
+    video_audio_streams.sort(key=lambda x: x['_height'], reverse=True)
+    video_only_streams.sort(key=lambda x: x['_height'], reverse=True)
+
+    # Auto-merge options for high quality: setdefault keeps the first
+    # (best) stream per height, and the dict preserves the sorted order,
+    # so one pass replaces the seen-set bookkeeping
+    auto_merge_streams = []
+    if audio_only_streams and video_only_streams:
+        best_audio = audio_only_streams[0]
+        by_height = {}
+        for v in video_only_streams:
+            if v['_height'] > 0:
+                by_height.setdefault(v['_height'], v)
+        auto_merge_streams = [_build_merge_option(v, best_audio)
+                              for v in by_height.values()]
+
+    return {
+        'video_info': video_info,
+        'video_audio_streams': video_audio_streams,
+        'video_only_streams': video_only_streams,
+        'audio_only_streams': audio_only_streams,
+        'auto_merge_streams': auto_merge_streams,
+    }
+
 @app.route('/analyze', methods=['POST'])
 def analyze_video():
     """Analyze YouTube video and return available formats"""
@@ -48,121 +774,234 @@ def analyze_video():
         if not url:
             flash('Please enter a YouTube URL', 'error')
             return redirect(url_for('index'))
-        
-        # Simple analysis - no restrictions
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            duration = info.get('duration', 0)
-            video_info = {
-                'title': info.get('title', 'Unknown'),
-                'author': info.get('uploader', 'Unknown'),
-                'length': f"{duration // 60}:{duration % 60:02d}",
-                'thumbnail': info.get('thumbnail', ''),
-                'video_id': info.get('id'),
-                'url': url,
-            }
-            
-            # Get all formats without filtering
-            formats = info.get('formats', [])
-            video_audio_streams = []
-            video_only_streams = []
-            audio_only_streams = []
-            
-            for fmt in formats:
-                height = fmt.get('height')
-                ext = fmt.get('ext', 'unknown')
-                vcodec = fmt.get('vcodec', 'none')
-                acodec = fmt.get('acodec', 'none')
-                filesize = fmt.get('filesize') or fmt.get('filesize_approx', 0)
-                
-                if ext == 'mhtml':
-                    continue
-                
-                stream = {
-                    'format_id': fmt['format_id'],
-                    'resolution': f"{height}p" if height else "Audio",
-                    'filesize': format_bytes(filesize),
-                    'ext': ext,
-                    'vcodec': vcodec,
-                    'acodec': acodec,
-                    'fps': fmt.get('fps'),
-                }
-                
-                if vcodec != 'none' and acodec != 'none':
-                    video_audio_streams.append(stream)
-                elif vcodec != 'none':
-                    video_only_streams.append(stream)
-                elif acodec != 'none':
-                    audio_only_streams.append(stream)
-            
-            # Sort by quality
-            video_audio_streams.sort(key=lambda x: int(x['resolution'].replace('p','')) if 'p' in x['resolution'] else 0, reverse=True)
-            video_only_streams.sort(key=lambda x: int(x['resolution'].replace('p','')) if 'p' in x['resolution'] else 0, reverse=True)
-            
-            # Auto-merge options for high quality
-            auto_merge_streams = []
-            if audio_only_streams and video_only_streams:
-                best_audio = audio_only_streams[0]
-                seen = set()
-                for v in video_only_streams:
-                    res = v['resolution']
-                    if res not in seen and 'p' in res:
-                        auto_merge_streams.append({
-                            'resolution': res,
-                            'fps': v['fps'],
-                            'video_format_id': v['format_id'],
-                            'audio_format_id': best_audio['format_id'],
-                            'vcodec': v['vcodec'],
-                            'acodec': best_audio['acodec'],
-                        })
-                        seen.add(res)
-            
-            return render_template('index.html',
-                video_info=video_info,
-                video_audio_streams=video_audio_streams,
-                video_only_streams=video_only_streams,
-                audio_only_streams=audio_only_streams,
-                auto_merge_streams=auto_merge_streams
-            )
-            
+        if not is_valid_youtube_url(url):
+            flash('Please enter a valid YouTube URL', 'error')
+            return redirect(url_for('index'))
+
+        # Run on the executor so the analysis shares the worker pool with
+        # the async API; this sync route just waits for the result.
+        future = ANALYZE_EXECUTOR.submit(_do_analyze, url)
+        return render_template('index.html', **future.result())
+
     except Exception as e:
         logging.error(f"Error analyzing video: {e}")
         flash(f"Error: {str(e)}", 'error')
         return redirect(url_for('index'))
 
+@app.route('/api/analyze', methods=['POST'])
+def start_analyze_job():
+    """Start a background analysis job and return its id"""
+    data = request.get_json(silent=True) or request.form
+    url = (data.get('url') or '').strip()
+    if not url:
+        return jsonify({'error': 'Missing URL'}), 400
+    if not is_valid_youtube_url(url):
+        return jsonify({'error': 'Invalid YouTube URL'}), 400
+
+    job_id = uuid.uuid4().hex
+    future = ANALYZE_EXECUTOR.submit(_do_analyze, url)
+    with _analyze_jobs_lock:
+        analyze_jobs[job_id] = {'future': future, 'created_at': time.time()}
+    return jsonify({'job_id': job_id}), 202
+
+@app.route('/api/analyze/status/<job_id>')
+def analyze_job_status(job_id):
+    """Poll a background analysis job"""
+    with _analyze_jobs_lock:
+        job = analyze_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    future = job['future']
+    if not future.done():
+        return jsonify({'status': 'running'})
+    try:
+        return jsonify({'status': 'completed', 'result': future.result()})
+    except Exception as e:
+        return jsonify({'status': 'error', 'error': str(e)})
+
+@app.route('/api/download/start', methods=['POST'])
+def start_download_job():
+    """Start a background download job and return its id"""
+    data = request.get_json(silent=True) or {}
+    url = (data.get('url') or '').strip()
+    mode = data.get('mode', 'single')
+    if not url:
+        return jsonify({'error': 'Missing URL'}), 400
+    if not is_valid_youtube_url(url):
+        return jsonify({'error': 'Invalid YouTube URL'}), 400
+
+    if mode == 'merge':
+        video_format_id = data.get('video_format_id')
+        audio_format_id = data.get('audio_format_id')
+        if not video_format_id or not audio_format_id:
+            return jsonify({'error': 'Missing format ids for merge'}), 400
+        if not HAS_FFMPEG:
+            # Fail fast rather than download both streams and then discover
+            # there is nothing to merge them with
+            return jsonify({'error': 'ffmpeg is required to merge streams but was not found'}), 409
+        format_spec = f"{video_format_id}+{audio_format_id}"
+    else:
+        format_id = data.get('format_id')
+        if not format_id:
+            return jsonify({'error': 'Missing format id'}), 400
+        format_spec = format_id
+
+    job_id, queue_position = download_manager.create_job(url, format_spec)
+    return jsonify({'job_id': job_id, 'queue_position': queue_position}), 202
+
+@app.route('/api/download/status/<job_id>')
+def download_job_status(job_id):
+    """Poll a background download job"""
+    status = download_manager.get_status(job_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+@app.route('/api/download/stream/<job_id>')
+def download_job_stream(job_id):
+    """Push job progress over Server-Sent Events.
+
+    One long-lived response replaces the 20-100 polls a download takes;
+    the JSON status route above stays as a fallback for clients without
+    EventSource support.
+    """
+    if download_manager.get_status(job_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+
+    def event_stream():
+        listener = download_manager.subscribe(job_id)
+        try:
+            snapshot = download_manager.get_status(job_id)
+            yield f"data: {json.dumps(snapshot)}\n\n"
+            while snapshot and snapshot['status'] not in ('completed', 'error'):
+                try:
+                    snapshot = listener.get(timeout=30)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing the idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {json.dumps(snapshot)}\n\n"
+        finally:
+            download_manager.unsubscribe(job_id, listener)
+
+    return Response(stream_with_context(event_stream()), mimetype='text/event-stream')
+
+@app.route('/api/download/file/<job_id>')
+def download_job_file(job_id):
+    """Send the finished file for a completed download job"""
+    job = download_manager.get_job(job_id)
+    if not job or job.status != 'completed':
+        return jsonify({'error': 'File not ready'}), 404
+    file_path, temp_dir = job.file_path, job.temp_dir
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'File no longer available'}), 404
+    download_name = os.path.basename(file_path)
+
+    # Behind nginx, hand the transfer over with X-Accel-Redirect: nginx
+    # serves the file via sendfile(2) and no bytes cross the Python worker.
+    # The proxy advertises the mapping as "X-Accel-Mapping: /fs/=/uri/".
+    accel_mapping = request.environ.get('HTTP_X_ACCEL_MAPPING', '')
+    if '=' in accel_mapping:
+        fs_prefix, uri_prefix = accel_mapping.split('=', 1)
+        if file_path.startswith(fs_prefix):
+            response = Response(mimetype='video/mp4')
+            response.headers['X-Accel-Redirect'] = uri_prefix + file_path[len(fs_prefix):]
+            # headers.set quotes/escapes the filename the same way send_file
+            # does below; the name comes from the video title
+            response.headers.set('Content-Disposition', 'attachment',
+                                 filename=download_name)
+            # nginx reads the file after this response returns, so the temp
+            # dir is left for the periodic purge instead of call_on_close
+            return response
+
+    response = send_file(file_path, as_attachment=True,
+                         download_name=download_name, conditional=True)
+
+    if job.dedup_key is None:
+        # Only jobs that can't be handed to a second requester may drop
+        # their file eagerly. Deduplicated jobs stay routable until the
+        # periodic JOB_TTL purge (as on the X-Accel branch above), so a
+        # retry or second client fetching after the first download still
+        # finds the file instead of a 404.
+        @response.call_on_close
+        def cleanup_after_request():
+            # The temp dir is only droppable once the bytes are sent, but
+            # the deletion itself happens on the cleanup worker so the
+            # response finalizes immediately
+            discard_dir(temp_dir)
+            download_manager.update_job(job_id, file_path=None, temp_dir=None)
+
+    return response
+
+@app.route('/preview')
+def preview_video():
+    """Preview a single stream in the browser without downloading"""
+    try:
+        url = request.args.get('url', '').strip()
+        itag = request.args.get('itag', '').strip()
+        if not url or not itag:
+            flash('Missing URL or format', 'error')
+            return redirect(url_for('index'))
+
+        info = get_video_info(url)
+        fmt = next((f for f in info.get('formats', []) if f.get('format_id') == itag), None)
+        if not fmt or not fmt.get('url'):
+            flash('Stream not available for preview', 'error')
+            return redirect(url_for('index'))
+
+        height = fmt.get('height')
+        video_info = {
+            'title': info.get('title', 'Unknown'),
+            'author': info.get('uploader', 'Unknown'),
+            'thumbnail': info.get('thumbnail', ''),
+            'url': url,
+            'itag': itag,
+            'resolution': f"{height}p" if height else None,
+            'fps': fmt.get('fps'),
+            'stream_url': fmt['url'],
+            'mime_type': f"video/{fmt.get('ext', 'mp4')}",
+        }
+        return render_template('preview.html', video_info=video_info)
+
+    except Exception as e:
+        logging.error(f"Preview error: {e}")
+        flash(f"Error: {str(e)}", 'error')
+        return redirect(url_for('index'))
+
 @app.route('/download/<format_id>')
 def download_video(format_id):
-    """Download video in specified format"""
+    """Download video in specified format, streaming it to the client"""
     try:
         url = request.args.get('url')
         if not url:
             flash('Missing URL', 'error')
             return redirect(url_for('index'))
-        
+
         ydl_opts = {
             'format': format_id,
-            'outtmpl': str(DOWNLOADS_DIR / '%(title)s.%(ext)s'),
             'progress_hooks': [progress_hook],
-            'merge_output_format': 'mp4',
             'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            **DOWNLOAD_TUNING,
         }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            if os.path.exists(filename):
-                return send_file(filename, as_attachment=True, download_name=os.path.basename(filename))
-            else:
-                flash('Download failed', 'error')
-                return redirect(url_for('index'))
-                
+        # The normal analyze/preview flow leaves the info cache warm, so
+        # the real title and extension are usually one dict lookup away;
+        # a cold cache falls back to the id-based mp4 name.
+        title, fmt = _cached_format(url, format_id)
+        if fmt:
+            ext = fmt.get('ext', 'mp4')
+            kind = 'audio' if fmt.get('vcodec') in (None, 'none') else 'video'
+            download_name = f"{yt_dlp.utils.sanitize_filename(title or 'video')}.{ext}"
+            mimetype = _EXT_MIME.get(ext) or f"{kind}/{ext}"
+        else:
+            download_name = f"{extract_video_id(url) or 'video'}.mp4"
+            mimetype = 'video/mp4'
+        # Single formats need no merge step, so the response can tail the
+        # file while it downloads
+        return stream_download(ydl_opts, url, download_name, progressive=True,
+                               mimetype=mimetype)
+
     except Exception as e:
         logging.error(f"Download error: {e}")
         flash(f"Error: {str(e)}", 'error')
@@ -170,36 +1009,30 @@ def download_video(format_id):
 
 @app.route('/download_merged/<video_format_id>/<audio_format_id>')
 def download_merged(video_format_id, audio_format_id):
-    """Download and merge video + audio"""
+    """Download and merge video + audio, streaming the result to the client"""
     try:
         url = request.args.get('url')
         if not url:
             flash('Missing URL', 'error')
             return redirect(url_for('index'))
-        
+        if not HAS_FFMPEG:
+            flash('ffmpeg is required to merge streams but was not found', 'error')
+            return redirect(url_for('index'))
+
         ydl_opts = {
             'format': f"{video_format_id}+{audio_format_id}",
-            'outtmpl': str(DOWNLOADS_DIR / '%(title)s.%(ext)s'),
             'progress_hooks': [progress_hook],
-            'merge_output_format': 'mp4',
             'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            **DOWNLOAD_TUNING,
         }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filename = ydl.prepare_filename(info)
-            
-            # yt-dlp may change extension after merge
-            if not os.path.exists(filename):
-                base = os.path.splitext(filename)[0]
-                filename = base + '.mp4'
-            
-            if os.path.exists(filename):
-                return send_file(filename, as_attachment=True, download_name=os.path.basename(filename))
-            else:
-                flash('Merge failed', 'error')
-                return redirect(url_for('index'))
-                
+        apply_merge_opts(ydl_opts, url, f"{video_format_id}+{audio_format_id}")
+        container = ydl_opts['merge_output_format']
+        download_name = f"{extract_video_id(url) or 'video'}.{container}"
+        return stream_download(ydl_opts, url, download_name, progressive=False,
+                               mimetype=_EXT_MIME.get(container) or f"video/{container}")
+
     except Exception as e:
         logging.error(f"Merge error: {e}")
         flash(f"Error: {str(e)}", 'error')
@@ -208,18 +1041,19 @@ def download_merged(video_format_id, audio_format_id):
 @app.route('/progress/<video_id>')
 def get_progress(video_id):
     """Get download progress"""
-    progress = download_progress.get(video_id, {'percentage': 0, 'status': 'waiting'})
-    return jsonify(progress)
+    progress = download_progress.get(video_id) or Progress()
+    return jsonify(asdict(progress))
+
+_BYTE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
 
 def format_bytes(bytes_size):
     """Format bytes to human readable"""
     if not bytes_size:
         return "Unknown"
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_size < 1024.0:
-            return f"{bytes_size:.1f} {unit}"
-        bytes_size /= 1024.0
-    return f"{bytes_size:.1f} TB"
+    # bit_length // 10 gives the unit index directly - one shift and one
+    # division instead of a divide-per-unit loop
+    idx = min((int(bytes_size).bit_length() - 1) // 10, len(_BYTE_UNITS) - 1)
+    return f"{bytes_size / (1 << (idx * 10)):.1f} {_BYTE_UNITS[idx]}"
 
 if __name__ == '__main__':
     print("=" * 60)